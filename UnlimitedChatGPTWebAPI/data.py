@@ -1,26 +1,62 @@
 import asyncio
+import base64
+import heapq
 import random
+import threading
 import time
 
+import async_timeout
+
+from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 from playwright.async_api import JSHandle
 from playwright._impl._api_types import Error
-from pydantic import BaseModel, root_validator
 
 try:
-    import ujson as json
+    import orjson
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
 except ModuleNotFoundError:
-    import json
+    try:
+        import ujson as json
+    except ModuleNotFoundError:
+        import json
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+    loads = json.loads
 
 
 class StreamResponseException(Exception):
     pass
 
 
+_COOKIES_PATH = Path(__file__).parent / "cookies.json"
+
+
+@lru_cache(maxsize=1024)
+def _parse_puid(puid: str):
+    """Split a puid into (user_id, expiry epoch)"""
+    [user_id, token] = puid.split(":")
+    return user_id, int(token.split("-")[0]) + 7 * 24 * 60 * 60
+
+
+@lru_cache(maxsize=1024)
+def _parse_cf(cf_clearance: str):
+    """Split a cf_clearance into (cf_id, expiry epoch)"""
+    [cf_id, expires, _, _, _, _] = cf_clearance.split("-")
+    return cf_id, int(expires) + 30 * 60
+
+
 class AsyncStreamIterator:
-    def __init__(self, response: JSHandle, timeout: int = 30):
-        self.response = response
+    def __init__(self, handle: JSHandle, timeout: int = 30):
+        self.handle = handle
         self.timeout = timeout
         self.reader: JSHandle = None
 
@@ -29,23 +65,27 @@ class AsyncStreamIterator:
 
     async def read(self):
         if not self.reader:
-            self.reader = await self.response.evaluate_handle(
-                "response => response.body.getReader()"
+            self.reader = await self.handle.evaluate_handle(
+                "h => h.response.body.getReader()"
             )
         try:
-            data = await self.reader.evaluate(
-                "reader => reader.read().then(({value, done}) => { return {done, value: Array.from(value)} })"
-            )
+            data = await self.reader.evaluate("reader => __uc.readChunk(reader)")
         except Error:
-            data = {"done": True, "value": None}
-        return data["done"], bytes(data["value"]) if data["value"] else b""
+            return True, b""
+        # done frames carry no value, everything else is a base64 payload
+        if data["done"]:
+            return True, b""
+        return False, base64.b64decode(data["value"])
 
     async def __anext__(self):
         try:
-            done, data = await asyncio.wait_for(self.read(), timeout=self.timeout)
+            # async_timeout arms a plain call_at handle instead of spawning
+            # a wrapper Task per chunk like asyncio.wait_for does
+            async with async_timeout.timeout(self.timeout):
+                done, data = await self.read()
             if done:
-                if isinstance(self.response, JSHandle):
-                    await self.response.dispose()
+                # the pair handle itself is disposed by StreamResponse.stop
+                if isinstance(self.reader, JSHandle):
                     await self.reader.dispose()
                 raise StopAsyncIteration
             return data
@@ -58,25 +98,28 @@ class StreamResponse:
         self,
         status: int = 0,
         headers: Dict[str, Any] = {},
-        controller: JSHandle = None,
-        response: JSHandle = None,
+        handle: JSHandle = None,
         timeout: int = 30,
     ):
         self.status: int = status
         self.headers: Dict[str, Any] = headers
-        self.controller: JSHandle = controller
-        self.response: JSHandle = response
+        self.handle: JSHandle = handle
         self.timeout = timeout
 
     async def read(self):
         """Read response payload."""
-        if self.response:
-            arrayBuffer = await self.response.evaluate(
-                "response => response.arrayBuffer().then((buffer) => Array.from(new Uint8Array(buffer)))"
-            )
+        if self.handle:
+            payload = await self.handle.evaluate("h => __uc.readAll(h.response)")
         else:
             raise StreamResponseException("Cannot read, response is None")
-        return bytes(arrayBuffer)
+        return base64.b64decode(payload)
+
+    async def read_all(self) -> bytes:
+        """Read the streamed response payload chunk by chunk."""
+        buf = bytearray()
+        async for chunk in self.iter_chunked():
+            buf.extend(chunk)
+        return bytes(buf)
 
     async def text(self, encoding="utf-8"):
         """Read response payload and decode."""
@@ -84,32 +127,32 @@ class StreamResponse:
 
     async def json(self):
         """Read response payload and decode as json."""
-        return json.loads(await self.text())
+        # loads accepts bytes, no need for the intermediate str
+        return loads(await self.read())
 
     async def stop(self):
         """Stop the response stream."""
-        if self.controller:
-            await self.controller.evaluate("controller => controller.abort()")
-            await self.controller.dispose()
+        if self.handle:
+            await self.handle.evaluate("h => h.controller.abort()")
+            await self.handle.dispose()
         else:
             raise StreamResponseException("controller is None")
 
     def iter_chunked(self) -> AsyncStreamIterator:
         """Returns an asynchronous iterator that yields chunks"""
-        if self.response:
-            return AsyncStreamIterator(self.response, timeout=self.timeout)
+        if self.handle:
+            return AsyncStreamIterator(self.handle, timeout=self.timeout)
         else:
             raise StreamResponseException("response is None")
 
     @staticmethod
-    async def wait_for_headers(
-        response: JSHandle, controller: JSHandle, timeout: int = 30
-    ):
+    async def wait_for_headers(handle: JSHandle, timeout: int = 30):
         """Wait for response headers."""
-        if response:
+        if handle:
             try:
-                status = await response.evaluate("response => response.status")
-                headers = await response.evaluate("response => get_headers(response)")
+                # one round-trip for both fields instead of two
+                data = await handle.evaluate("h => __uc.fetchHeaders(h.response)")
+                status, headers = data["status"], data["headers"]
             except Error:
                 raise StreamResponseException("Fetch Error, Please try again later")
             except Exception:
@@ -119,20 +162,60 @@ class StreamResponse:
         return StreamResponse(
             status=status,
             headers=headers,
-            controller=controller,
-            response=response,
+            handle=handle,
             timeout=timeout,
         )
 
 
-class CookieManager(BaseModel):
-    cf_clearances: Dict[str, Dict[str, Any]] = {}
-    puids: Dict[str, Dict[str, Any]] = {}
-    __file_path = Path(__file__).parent / "cookies.json"
+@dataclass
+class CookieManager:
+    cf_clearances: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    puids: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        if _COOKIES_PATH.is_file():
+            data = loads(_COOKIES_PATH.read_bytes())
+            self.cf_clearances = data.get("cf_clearances", {})
+            self.puids = data.get("puids", {})
+        self._dirty: bool = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = threading.Lock()
+        self._puid_keys = list(self.puids)
+        self._cf_keys = list(self.cf_clearances)
+        self._puid_heap = [
+            (info["expires"], user_id)
+            for user_id, info in self.puids.items()
+            if info.get("expires") is not None
+        ]
+        heapq.heapify(self._puid_heap)
+        self._cf_heap = [
+            (info["expires"], cf_id)
+            for cf_id, info in self.cf_clearances.items()
+            if info.get("expires") is not None
+        ]
+        heapq.heapify(self._cf_heap)
+
+    def _purge(self) -> None:
+        """Drop expired entries so the store and its JSON stay small"""
+        now = time.time()
+        for heap, entries in (
+            (self._puid_heap, self.puids),
+            (self._cf_heap, self.cf_clearances),
+        ):
+            while heap and heap[0][0] < now:
+                expires, key = heapq.heappop(heap)
+                info = entries.get(key)
+                # skip entries overwritten with a later expiry
+                if info is not None and info.get("expires") == expires:
+                    del entries[key]
 
     @property
     def file_path(self) -> Path:
-        return self.__class__.__file_path
+        return _COOKIES_PATH
+
+    def dict(self) -> Dict[str, Any]:
+        """Plain-dict view used for serialization"""
+        return {"cf_clearances": self.cf_clearances, "puids": self.puids}
 
     def get_puid(self, user_id):
         if user_id not in self.puids:
@@ -150,29 +233,45 @@ class CookieManager(BaseModel):
     @property
     def puid(self) -> str:
         """Return a random puid"""
-        if not self.puids:
-            return ""
-        user_id = random.choice(list(self.puids.keys()))
-        if puid := self.get_puid(user_id=user_id):
-            return puid
-        return self.puid
+        self._purge()
+        keys = self._puid_keys
+        if len(keys) != len(self.puids):
+            # the dict was mutated directly (get_puid expiry), resync
+            keys = self._puid_keys = list(self.puids)
+        while keys:
+            idx = random.randrange(len(keys))
+            if puid := self.get_puid(user_id=keys[idx]):
+                return puid
+            # dead entry, swap-remove so selection stays O(1)
+            keys[idx] = keys[-1]
+            keys.pop()
+        return ""
 
     def save_puid(self, puid: str) -> None:
         """Save a puid"""
-        [user_id, token] = puid.split(":")
-        expires: int = int(token.split("-")[0]) + 7 * 24 * 60 * 60
+        user_id, expires = _parse_puid(puid)
+        if user_id not in self.puids:
+            self._puid_keys.append(user_id)
         self.puids[user_id] = {"puid": puid, "expires": expires}
+        heapq.heappush(self._puid_heap, (expires, user_id))
         self.save()
 
     @property
     def cf_clearance(self) -> str:
         """Return a random cf_clearance"""
-        if not self.cf_clearances:
-            return ""
-        cf_id = random.choice(list(self.cf_clearances.keys()))
-        if cf_clearance := self.get_cf_clearance(cf_id=cf_id):
-            return cf_clearance
-        return self.cf_clearance
+        self._purge()
+        keys = self._cf_keys
+        if len(keys) != len(self.cf_clearances):
+            # the dict was mutated directly (expiry or delete), resync
+            keys = self._cf_keys = list(self.cf_clearances)
+        while keys:
+            idx = random.randrange(len(keys))
+            if cf_clearance := self.get_cf_clearance(cf_id=keys[idx]):
+                return cf_clearance
+            # dead entry, swap-remove so selection stays O(1)
+            keys[idx] = keys[-1]
+            keys.pop()
+        return ""
 
     def get_cf_clearance(self, cf_id):
         """Get a cf_clearance"""
@@ -191,30 +290,46 @@ class CookieManager(BaseModel):
     def save_cf_clearance(self, cf_clearance: str) -> None:
         """Save a cf_clearance"""
         if cf_clearance:
-            [cf_id, expires, _, _, _, _] = cf_clearance.split("-")
-            expires: int = int(expires) + 30 * 60
+            cf_id, expires = _parse_cf(cf_clearance)
+            if cf_id not in self.cf_clearances:
+                self._cf_keys.append(cf_id)
             self.cf_clearances[cf_id] = {
                 "cf_clearance": cf_clearance,
                 "expires": expires,
             }
+            heapq.heappush(self._cf_heap, (expires, cf_id))
             self.save()
 
     def delete_cf_clearance(self, cf_clearance: str) -> bool:
         """Delete a cf_clearance"""
         if cf_clearance:
-            [cf_id, expires, _, _, _, _] = cf_clearance.split("-")
+            cf_id, _ = _parse_cf(cf_clearance)
             if cf_id in self.cf_clearances:
                 del self.cf_clearances[cf_id]
                 self.save()
                 return True
         return False
 
-    @root_validator(pre=True)
-    def init(cls, values: Dict[str, Any]) -> Dict[str, Any]:
-        if cls.__file_path.is_file():
-            return json.loads(cls.__file_path.read_text("utf-8"))
-        return values
-
     def save(self) -> None:
-        """Save cookies to file"""
-        self.file_path.write_text(self.json(), encoding="utf-8")
+        """Save cookies to file, debounced when an event loop is running"""
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop to defer to, write synchronously
+            self._write()
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        """Coalesce a burst of saves into a single write off the loop"""
+        await asyncio.sleep(0.5)
+        loop = asyncio.get_running_loop()
+        while self._dirty:
+            self._dirty = False
+            await loop.run_in_executor(None, self._write)
+
+    def _write(self) -> None:
+        with self._write_lock:
+            self.file_path.write_bytes(dumps(self.dict()))
@@ -28,6 +28,62 @@ function trackedFetch(...args) {
         })
 }
 
+const b64encode = (bytes) => {
+    let chars = '';
+    for (let i = 0; i < bytes.length; i += 0x8000) {
+        chars += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+    }
+    return btoa(chars);
+}
+
+// Helpers called by name from Python evaluates, so V8 compiles them once
+// per page instead of re-parsing the same lambda source on every call.
+window.__uc = {
+    // One round-trip to create the abort controller and start the fetch;
+    // Python keeps a single handle to the {controller, response} pair.
+    startFetch: async (url, method, headers, body) => {
+        const controller = new AbortController();
+        const response = await trackedFetch(url, {
+            method: method,
+            headers: headers,
+            body: body,
+            signal: controller.signal
+        });
+        return {controller, response};
+    },
+    fetchHeaders: (response) => ({
+        status: response.status,
+        headers: get_headers(response)
+    }),
+    readAll: (response) => response.arrayBuffer()
+        .then((buffer) => b64encode(new Uint8Array(buffer))),
+    // Coalesce several reader.read() results into one round-trip: tiny
+    // SSE frames would otherwise cost a full IPC call each. A buffered
+    // tail at EOF is returned as a normal chunk, the next call then
+    // reports done.
+    readChunk: async (reader) => {
+        const parts = [];
+        let total = 0;
+        while (total < 16384) {
+            const {value, done} = await reader.read();
+            if (done) {
+                if (!parts.length) return {done: true};
+                break;
+            }
+            parts.push(value);
+            total += value.length;
+            if (value.includes(10)) break;
+        }
+        const merged = new Uint8Array(total);
+        let offset = 0;
+        for (const part of parts) {
+            merged.set(part, offset);
+            offset += part.length;
+        }
+        return {done: false, value: b64encode(merged)};
+    }
+};
+
 function waitForNoFetch(timeout = 30000) {
     const noFetchPromise = new Promise(resolve => {
         const checkInterval = setInterval(() => {
@@ -1,9 +1,10 @@
 import asyncio
 import random
+import re
 
 from typing import Optional
 from contextlib import asynccontextmanager
-from urllib.parse import urlsplit
+from functools import lru_cache
 from loguru import logger
 from pathlib import Path
 from playwright.async_api import (
@@ -25,6 +26,21 @@ from .data import CookieManager, StreamResponse
 SESSION_TOKEN_KEY = "__Secure-next-auth.session-token"
 CF_CLEARANCE_KEY = "cf_clearance"
 
+_PRELOAD_JS = str(Path(__file__).parent / "js" / "preload.js")
+
+# strip "scheme://host" so only the path (plus query) remains
+_URL_PREFIX_RE = re.compile(r"^[a-z][a-z0-9+.-]*://[^/?#]*", re.IGNORECASE)
+_SESSION_PATH_RE = re.compile(
+    r"/$|session$|^/(?:_next/data|c/|api/auth/callback/auth0)"
+)
+
+
+@lru_cache(maxsize=1024)
+def _uses_session_token(url: str) -> bool:
+    """Whether requests to this URL should carry the session token"""
+    path = _URL_PREFIX_RE.sub("", url, count=1).partition("?")[0].partition("#")[0]
+    return _SESSION_PATH_RE.search(path) is not None
+
 
 class ChatSessionException(Exception):
     pass
@@ -50,12 +66,14 @@ class ChatSession:
         self.page: Page = None
         self.available = False
         self.running = False
+        self._cached_cookies: dict = {}
+        self._free_cond: Optional[asyncio.Condition] = None
 
-    async def set_status(self, status: bool):
-        self.available = status
-
-    async def get_status(self):
-        return self.available
+    async def _notify_free(self):
+        """Wake waiters in the owning SessionManager"""
+        if self._free_cond is not None:
+            async with self._free_cond:
+                self._free_cond.notify_all()
 
     async def __aenter__(self) -> "ChatSession":
         """Enter Async Context Manager"""
@@ -80,9 +98,12 @@ class ChatSession:
         ua = f"Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:72.0) Gecko/20100101 Firefox/{self.browser.version}"
         # ua = f"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{self.browser.version} Safari/537.36"
         self.content = await self.browser.new_context(user_agent=ua)
+        self._cached_cookies.clear()
 
     async def set_cookie(self, key: str, value: str, expires: float = -1):
-        """Set Cookie"""
+        """Set Cookie, skipping the CDP call when the value is unchanged"""
+        if self._cached_cookies.get(key) == value:
+            return
         await self.content.add_cookies(
             [
                 {
@@ -96,12 +117,42 @@ class ChatSession:
                 }
             ]
         )
+        self._cached_cookies[key] = value
 
-    async def get_cookie(self, key: str) -> str:
-        """Get Cookie"""
+    async def set_cookies(self, cookies: dict):
+        """Set multiple cookies in one CDP call, skipping unchanged values"""
+        changed = {
+            key: value
+            for key, value in cookies.items()
+            if self._cached_cookies.get(key) != value
+        }
+        if not changed:
+            return
+        await self.content.add_cookies(
+            [
+                {
+                    "name": key,
+                    "value": value,
+                    "domain": "chat.openai.com",
+                    "path": "/",
+                    # an empty value means deletion, expire it immediately
+                    "expires": -1 if value else 0,
+                    "httpOnly": False,
+                    "secure": True,
+                }
+                for key, value in changed.items()
+            ]
+        )
+        self._cached_cookies.update(changed)
+
+    async def get_cookie(self, key: str, use_cache: bool = True) -> str:
+        """Get Cookie, preferring the local cache over a CDP round-trip"""
+        if use_cache and key in self._cached_cookies:
+            return self._cached_cookies[key]
         cookies = await self.content.cookies()
         for cookie in cookies:
             if cookie["name"] == key:
+                self._cached_cookies[key] = cookie["value"]
                 return cookie["value"]
         return ""
 
@@ -123,14 +174,14 @@ class ChatSession:
         await self.playwright_start()
         page = await self.content.new_page()
         self.page = page
-        await page.add_init_script(path=Path(__file__).parent / "js" / "preload.js")
+        await page.add_init_script(path=_PRELOAD_JS)
         await self.get_cf_cookies()
         await page.expose_function("set_cookie", self.set_cookie)
         await page.expose_function("get_cookie", self.get_cookie)
         return page
 
     async def get_cf_cookies(self, retry: int = 20, wait: bool = False) -> None:
-        await self.set_status(False)
+        self.available = False
         if wait:
             await self.wait_for_task()
         logger.debug("Start get Cloudflare cookies")
@@ -176,15 +227,17 @@ class ChatSession:
             logger.error("Get Cloudflare cookies failed")
             asyncio.ensure_future(self.get_cf_cookies())
             return
-        await self.set_status(True)
-        self.cf_clearance = await self.get_cookie(CF_CLEARANCE_KEY)
+        self.available = True
+        await self._notify_free()
+        # the challenge sets the cookie browser-side, bypass the cache
+        self.cf_clearance = await self.get_cookie(CF_CLEARANCE_KEY, use_cache=False)
         self.cookie_manager.save_cf_clearance(self.cf_clearance)
         logger.debug("Get Cloudflare cookies success")
 
     async def wait_for_task(self, timeout: int = 60):
         """Wait for task, called when restart"""
         logger.debug("Wait for task...")
-        await self.set_status(False)
+        self.available = False
         await self.page.evaluate(
             "([timeout]) => waitForNoFetch(timeout)", [timeout * 1000]
         )
@@ -200,25 +253,24 @@ class ChatSession:
         timeout: int = 30,
     ):
         """Fetch API"""
-        if cookies.__len__():
-            self.running = True
-            for key, value in cookies.items():
-                await self.set_cookie(key, value)
-        controller = await self.page.evaluate_handle("new AbortController()")
+        if cookies:
+            await self.set_cookies(cookies)
         # Execute the JavaScript code in the page
         # to send the request directly on the current page
         # and use Streams API to process the request result
-        response = await controller.evaluate_handle(
-            "(controller, [url, method, headers, data]) => {return trackedFetch(url, {method: method, headers: headers, body: data, signal: controller.signal})}",
+        handle = await self.page.evaluate_handle(
+            "([url, method, headers, data]) => __uc.startFetch(url, method, headers, data)",
             [url, method, headers, data if data else None],
         )
-        resp = await StreamResponse.wait_for_headers(
-            controller=controller, response=response, timeout=timeout
-        )
-        yield resp
-        self.running = False
-        await controller.evaluate("--fetchCounter")
-        await resp.stop()
+        resp = await StreamResponse.wait_for_headers(handle=handle, timeout=timeout)
+        try:
+            yield resp
+            await handle.evaluate("h => --fetchCounter")
+            await resp.stop()
+        finally:
+            # release the session even if the consumer raised mid-stream
+            self.running = False
+            await self._notify_free()
 
     @asynccontextmanager
     async def _call_api(
@@ -235,14 +287,12 @@ class ChatSession:
             logger.debug(f"Call API: {method} {url}")
             if session_token:
                 self.running = True
-                await self.set_cookie(SESSION_TOKEN_KEY, session_token)
-            else:
-                await self.set_cookie(SESSION_TOKEN_KEY, "", expires=0)
             async with self.fetch(
                 method,
                 url,
                 headers=headers,
                 data=data,
+                cookies={SESSION_TOKEN_KEY: session_token or ""},
                 timeout=timeout,
             ) as response:
                 if response.status == 403:
@@ -256,12 +306,15 @@ class ChatSession:
                         "Too many session requests, trying to get new Cloudflare cookies..."
                     )
                     response.status = 403
-                    if await self.get_status():
+                    if self.available:
                         asyncio.ensure_future(self.init_page(restart=True))
                     yield response
                     return
                 if session_token:
-                    if token := await self.get_cookie(SESSION_TOKEN_KEY):
+                    # the server may rotate the token, bypass the cache
+                    if token := await self.get_cookie(
+                        SESSION_TOKEN_KEY, use_cache=False
+                    ):
                         response.headers[
                             "set-cookie"
                         ] = f"{SESSION_TOKEN_KEY}={token}; path=/; max-age=31536000; secure; httponly"
@@ -281,11 +334,13 @@ class SessionManager:
         limit=4,
     ):
         self.limit = limit
+        self._free_cond = asyncio.Condition()
         self.sessions = [
             ChatSession(proxies=proxies, cookie_manager=cookie_manager)
             for _ in range(limit)
         ]
         for session in self.sessions:
+            session._free_cond = self._free_cond
             asyncio.ensure_future(session.init_page())
 
     async def get_sessions(self):
@@ -293,17 +348,21 @@ class SessionManager:
         return [
             session
             for session in self.sessions
-            if (await session.get_status() and not session.running)
+            if session.available and not session.running
         ]
 
     async def get_session(self):
-        """Get a random available session"""
-        sessions = await self.get_sessions()
-        if sessions:
-            return random.choice(sessions)
-        else:
-            await asyncio.sleep(3)
-            return await self.get_session()
+        """Get a random available session, waiting until one frees"""
+        async with self._free_cond:
+            while True:
+                sessions = [
+                    session
+                    for session in self.sessions
+                    if session.available and not session.running
+                ]
+                if sessions:
+                    return random.choice(sessions)
+                await self._free_cond.wait()
 
     @asynccontextmanager
     async def call_api(
@@ -317,17 +376,11 @@ class SessionManager:
     ):
         """Call API with a random session"""
         session = await self.get_session()
-        url_split = urlsplit(url)
         # Ignore session_token when calling API that does not need to use session_token
         if (
             not session_token
             or headers.get("authorization")
-            or not (
-                url_split.path.endswith(("/", "session"))
-                or url_split.path.startswith(
-                    ("/_next/data", "/c/", "/api/auth/callback/auth0")
-                )
-            )
+            or not _uses_session_token(url)
         ):
             session_token = None
         async with session._call_api(
@@ -14,9 +14,7 @@ async def main():
             url="/backend-api/models",
             headers={"Authorization": "Bearer xxx"}
         ) as resp:
-            data = b""
-            async for chunk in resp.iter_chunked():
-                data += chunk
+            data = await resp.read_all()
             print(data.decode())
 
 if __name__ == "__main__":